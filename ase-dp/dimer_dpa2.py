@@ -1,10 +1,18 @@
+import os
+
+# threads must be set before importing numpy and deepmd_pt, 
+# which read them only at import time
+omp = 16
+os.environ['OMP_NUM_THREADS'] = f'{omp}'
+os.environ['MKL_NUM_THREADS'] = f'{omp}'
+os.environ['OPENBLAS_NUM_THREADS'] = f'{omp}'
+
 from ase.io import read, write
 from ase import Atoms
 from ase.optimize import BFGS, FIRE, QuasiNewton
 from ase.io import Trajectory, read, write
 from ase.mep import DimerControl, MinModeAtoms, MinModeTranslate
 from ase.calculators.abacus import Abacus, AbacusProfile
-import os
 import numpy as np
 
 from deepmd_pt.utils.ase_calc import DPCalculator as DP
@@ -17,7 +25,6 @@ init_eigenmode_method = 'displacement'
 displacement_input = 'displacement_vector.npy'
 
 # setting for calculator
-omp = 16
 moving_atoms_ind = None
 
 class DPDimer:
@@ -50,15 +57,14 @@ class DPDimer:
         
     def set_calculator(self):
         """Set Abacus calculators"""
-        os.environ['OMP_NUM_THREADS'] = 'omp'
         calc = DP(model=self.model)
         return calc
     
     def set_d_mask_by_displacement(self):
         """set mask by displacement"""
         print("=== Set mask by displacement vector where displacement is [0,0,0] ===")
-        d_mask = self.displacement_vector != np.zeros(3)
-        d_mask = d_mask[:,0].tolist()
+        # atom is moving if displacement in any direction is non-zero
+        d_mask = np.any(self.displacement_vector != 0.0, axis=1).tolist()
         return d_mask
     
     def set_d_mask_by_constraint(self):
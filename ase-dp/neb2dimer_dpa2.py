@@ -2,16 +2,45 @@
 # Using DPA2 model to search TS via NEB-DIMER
 # Last Update: 2024-02-21
 
-import numpy as np
 import os
 import sys
+import io
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+# threads must be set before importing numpy, torch and deepmd_pt, 
+# which read them only at import time
+omp = 16
+os.environ['OMP_NUM_THREADS'] = f'{omp}'
+os.environ['MKL_NUM_THREADS'] = f'{omp}'
+os.environ['OPENBLAS_NUM_THREADS'] = f'{omp}'
+
+import numpy as np
+import torch
+
+torch.set_num_threads(omp)
+torch.set_num_interop_threads(1)
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, jitted kernels run as plain numpy without it
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 from ase.io import read, write, Trajectory
-from ase import Atoms
+from ase import Atoms, units
 from ase.optimize import BFGS, FIRE, QuasiNewton
 from ase.constraints import FixAtoms
+from ase.calculators.calculator import PropertyNotImplementedError
+from ase.calculators.singlepoint import SinglePointCalculator
 from ase.visualize import view
-from ase.mep.neb import NEBTools, NEB, DyNEB
+from ase.mep.neb import NEBTools, NEB, DyNEB, BaseNEB
 from ase.mep.autoneb import AutoNEB
 from ase.mep.dimer import DimerControl, MinModeAtoms, MinModeTranslate
 from ase.vibrations import Vibrations
@@ -26,13 +55,16 @@ neb_fmax = 0.80  # neb should be rough
 dimer_fmax = 0.05 # dimer use neb guess
 climb = True
 scale_fmax = 1.0 # use dyneb to reduce message far from TS
-omp = 16
 neb_algorism = "improvedtangent"
+compile_model = True # use torch.compile to fuse kernels of DP model
+neb_precision = "float32" # DP precision in rough NEB, None for model default. dimer and vibration keep model default
+vib_parallel = False # run TS, IS and FS vibrations in parallel processes instead of one batch
+vib_gpus = None # CUDA devices for parallel vibrations like ["0", "1", "2"], None for pinning omp CPU cores to each process
 neb_traj = "neb_dpa2_raw.traj"
 dimer_traj = "dimer_dpa2.traj"
-os.environ['OMP_NUM_THREADS'] = "omp"
+ROOT_DIR = Path.cwd()
 
-# reading part
+# usage message
 msg = '''
 Usage: 
 - For using IS and FS: 
@@ -40,61 +72,210 @@ Usage:
 - For using existing NEB: 
     python neb2dimer_dpa2.py [neb_latest.traj]
 '''
-if len(sys.argv) < 2:
-    print(msg)
-    sys.exit(1)
-elif len(sys.argv) == 2:
-    if sys.argv[1] == "-h" or sys.argv[1] == "--help":
-        print(msg)
-        sys.exit(0)
-    else:
-        neb_traj = sys.argv[1]
-        neb_abacus = read(neb_traj, ":", format="traj")
-        atom_init = neb_abacus[0]
-        atom_final = neb_abacus[-1]
-        assert type(atom_init) == Atoms and type(atom_final) == Atoms, \
-        "The input file is not a trajectory file contained Atoms object"
-else:
-    init_stru = sys.argv[1]
-    final_stru = sys.argv[2]
-    if len(sys.argv) == 4:
-        format = sys.argv[3]
-    else:
-        format = None # auto detect
-    atom_init = read(init_stru, format=format)
-    atom_final = read(final_stru, format=format)
-
-atom_init.calc = DP(model=model)
-atom_final.calc = DP(model=model)
-init_relax = BFGS(atom_init)
-final_relax = BFGS(atom_final)
-init_relax.run(fmax=0.05)
-final_relax.run(fmax=0.05)
-
-write("init_opted.traj", atom_init, format="traj")
-write("final_opted.traj", atom_final, format="traj")
 
 # run neb and dimer 
 # function setting
 
+@lru_cache(maxsize=1)
+def get_dp_calculator(model):
+    """Load DP model only once, the calculator is shared by the whole workflow"""
+    return DP(model=model)
+
+class FallbackModel(torch.nn.Module):
+    """Run compiled model, switch to original model for good on its first failure
+    
+    Compiled graphs may fail for input shapes not seen in warm-up, 
+    like batches of many NEB images
+    """
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.compiled = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=True)
+        self.use_compiled = True
+    
+    def forward(self, *args, **kwargs):
+        if self.use_compiled:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as err:
+                print(f"--- Notice: compiled DP model failed, use original model: {err} ---")
+                self.use_compiled = False
+        return self.model(*args, **kwargs)
+
+def compile_dp_calculator(calc, atoms):
+    """Compile torch model of DP calculator and warm it up by one evaluation
+    
+    Falls back to the original model if compilation is not supported, 
+    during warm-up or in any later evaluation
+    
+    calc (DPCalculator): DP calculator whose torch model will be compiled
+    atoms (Atoms object): structure used to warm up the compiled model
+    """
+    calc.dp.dp = FallbackModel(calc.dp.dp)
+    dp_batch_calculate(calc, [atoms.copy()])
+
+def cast_tensors(obj, dtype):
+    """Cast floating tensors in (nested) tensor, dict, list or tuple to dtype"""
+    if isinstance(obj, torch.Tensor):
+        return obj.to(dtype) if obj.is_floating_point() else obj
+    if isinstance(obj, dict):
+        return {key: cast_tensors(value, dtype) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([cast_tensors(value, dtype) for value in obj])
+    return obj
+
+class CastModel(torch.nn.Module):
+    """Run wrapped model in given dtype, cast inputs and outputs at the model boundary"""
+    
+    def __init__(self, model, dtype, out_dtype):
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+        self.out_dtype = out_dtype
+    
+    def forward(self, *args, **kwargs):
+        args = cast_tensors(args, self.dtype)
+        kwargs = cast_tensors(kwargs, self.dtype)
+        return cast_tensors(self.model(*args, **kwargs), self.out_dtype)
+
+@contextmanager
+def dp_precision(calc, dtype, probe=None):
+    """Temporarily run torch model of DP calculator in lower precision
+    
+    Original parameters and buffers are saved before casting and loaded back on exit, 
+    so the model is exactly the same afterwards.
+    If the probe evaluation fails in given precision, original precision is kept
+    
+    calc (DPCalculator): DP calculator whose torch model precision will be changed
+    dtype (str): torch dtype name like 'float32' or 'bfloat16', None for doing nothing
+    probe (Atoms object): structure used to check the model works in given precision
+    """
+    if dtype is None:
+        yield
+        return
+    model = calc.dp.dp
+    out_dtype = next(model.parameters()).dtype
+    # casting back from lower precision does not recover the rounded values
+    saved_state = {key: value.detach().clone() for key, value in model.state_dict().items()}
+
+    def restore_model():
+        model.to(out_dtype)
+        model.load_state_dict(saved_state)
+        calc.dp.dp = model
+
+    model.to(getattr(torch, dtype))
+    calc.dp.dp = CastModel(model, getattr(torch, dtype), out_dtype)
+    try:
+        if probe is not None:
+            try:
+                dp_batch_calculate(calc, [probe.copy()])
+            except Exception as err:
+                print(f"--- Notice: DP model can not run in {dtype}, use original precision: {err} ---")
+                restore_model()
+        yield
+    finally:
+        restore_model()
+
+def snapshot_atoms(atoms, properties=("energy", "forces")):
+    """Copy Atoms with its calculated properties stored in a SinglePointCalculator"""
+    snapshot = atoms.copy()
+    if atoms.calc is not None:
+        results = {}
+        for prop in properties:
+            try:
+                results[prop] = atoms.calc.get_property(prop, atoms)
+            except PropertyNotImplementedError:
+                pass
+        snapshot.calc = SinglePointCalculator(snapshot, **results)
+    return snapshot
+
+class AsyncTrajectoryWriter:
+    """Write Atoms snapshots to trajectory file in a background thread
+    
+    Optimizer puts snapshots into a queue and a single consumer thread writes them,
+    so trajectory I/O overlaps with next DP evaluation
+    """
+    
+    def __init__(self, filename, mode='w', maxsize=8):
+        """Open trajectory file and start the writer thread
+        
+        filename (str): trajectory file name
+        mode (str): 'w' for write and 'a' for append
+        maxsize (int): maximum number of queued snapshots, optimizer waits when the queue is full
+        """
+        self.traj = Trajectory(filename, mode)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+    
+    def _write_loop(self):
+        while True:
+            images = self.queue.get()
+            if images is None:
+                break
+            try:
+                for atoms in images:
+                    self.traj.write(atoms)
+            except Exception as err:
+                self.error = err
+                break
+    
+    def _put(self, item):
+        """queue item while writer thread is alive, return False if it has stopped"""
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def put(self, images):
+        """queue a list of Atoms snapshots to be written as consecutive frames
+        
+        write error of the writer thread is raised here immediately
+        """
+        if self.error is None:
+            self._put(images)
+        if self.error is not None:
+            raise self.error
+    
+    def close(self):
+        """flush queued snapshots and close trajectory file"""
+        self._put(None)
+        self.thread.join()
+        self.traj.close()
+        if self.error is not None:
+            raise self.error
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
 class DPDimer:
     """Customize Dimer calculation workflow by using Deep Potential"""
     
     def __init__(self, init_Atoms, model,
-                 omp=1, directory='DIMER', 
+                 omp=None, directory='DIMER', 
                  traj_file='dimer.traj',
                  init_eigenmode_method='displacement',
-                 displacement_vector: np.ndarray = None,):
+                 displacement_vector: np.ndarray = None,
+                 calc=None,):
         """Initialize Dimer method by using ASE-DP
 
         init_Atoms (Atoms object): starting image, can be from every way including NEB result
         parameters (dict): settings of abacus input parameters
         model (str): DeepPotential model
         directory (str): calculator directory name, for parallel calculation {directory}-rank{i} will be the directory name
-        omp (int): number of OpenMP for DP calculator
+        omp (int): kept for compatibility, threads are set by OMP_NUM_THREADS before importing torch
         traj_file (str): trajectory file name for dimer calculation, when running dimer calculation, trajetory will be written to this file, default is 'dimer.traj'
         init_eigenmode_method (str): dimer initial eigenmode method. Choose from 'displacement' and 'gauss'.
         displacement_vector (np.ndarray): displacement vector for dimer initial eigenmode. Only used when init_eigenmode_method is 'displacement'
+        calc (DPCalculator): DP calculator to use, default is the cached calculator of model
         """
         self.init_Atoms = init_Atoms
         self.model = model
@@ -103,18 +284,22 @@ class DPDimer:
         self.traj_file = traj_file
         self.init_eigenmode_method = init_eigenmode_method
         self.displacement_vector = displacement_vector
+        self.calc = calc
+        # keep only initial positions instead of a copy of init_Atoms, for restarting dimer
+        self.init_positions = init_Atoms.get_positions()
+        self.d_control = None
         
     def set_calculator(self):
-        """Set Abacus calculators"""
-        os.environ['OMP_NUM_THREADS'] = f'{self.omp}'
-        calc = DP(model=self.model)
-        return calc
+        """Set DP calculators"""
+        if self.calc is not None:
+            return self.calc
+        return get_dp_calculator(self.model)
     
     def set_d_mask_by_displacement(self):
         """set mask by displacement"""
         print("=== Set mask by displacement vector where displacement is [0,0,0] ===")
-        d_mask = self.displacement_vector != np.zeros(3)
-        d_mask = d_mask[:,0].tolist()
+        # atom is moving if displacement in any direction is non-zero
+        d_mask = np.any(self.displacement_vector != 0.0, axis=1).tolist()
         return d_mask
     
     def set_d_mask_by_constraint(self):
@@ -145,16 +330,9 @@ class DPDimer:
             d_mask[ind] = True
         return d_mask
         
-    def run(self, fmax=0.05, properties=["energy", "forces", "stress"], moving_atoms_ind: list = None):
-        """run dimer calculation workflow
-        
-        Args:
-            fmax (float): threshold (unit: eV/Angstrom) of the force convergence
-            properties (list): properties dumped in trajectory files, default ['energy', 'forces', 'stress']
-        """
+    def set_dimer_control(self, moving_atoms_ind: list = None):
+        """set DimerControl with mask for init Atoms"""
         dimer_init = self.init_Atoms
-        dimer_init.calc = self.set_calculator()
-        dimer_traj = Trajectory(self.traj_file, 'w', dimer_init, properties=properties)
         if self.init_eigenmode_method == "displacement":
             if moving_atoms_ind:
                 d_mask = self.set_d_mask_by_specified(moving_atoms_ind)
@@ -164,120 +342,439 @@ class DPDimer:
             d_control = DimerControl(initial_eigenmode_method=self.init_eigenmode_method, 
                                     displacement_method="vector", 
                                     mask=d_mask)
-            d_atoms = MinModeAtoms(dimer_init, d_control)
-            d_atoms.displace(displacement_vector=self.displacement_vector)
         elif self.init_eigenmode_method == "gauss":
             # leave a way for random displacement
             d_mask = self.set_d_mask_by_constraint()
             d_control = DimerControl(initial_eigenmode_method=self.init_eigenmode_method, 
                                     mask=d_mask)
-            d_atoms = MinModeAtoms(dimer_init, d_control)
         else:
             raise ValueError("init_eigenmode_method must be displacement or gauss")
-        dimer_relax = MinModeTranslate(d_atoms, trajectory=dimer_traj)
-        dimer_relax.run(fmax=fmax)
+        return d_control
         
+    def run(self, fmax=0.05, properties=["energy", "forces", "stress"], moving_atoms_ind: list = None):
+        """run dimer calculation workflow
+        
+        Args:
+            fmax (float): threshold (unit: eV/Angstrom) of the force convergence
+            properties (list): properties dumped in trajectory files, default ['energy', 'forces', 'stress']
+            moving_atoms_ind (list): indices of moving atoms, others are masked. Only used in first run
+        """
+        if self.init_eigenmode_method == "displacement" and self.displacement_vector is None:
+            raise ValueError("displacement_vector must be given when init_eigenmode_method is displacement")
+        dimer_init = self.init_Atoms
+        if self.d_control is None:
+            dimer_init.calc = self.set_calculator()
+            self.d_control = self.set_dimer_control(moving_atoms_ind)
+        else:
+            # repeated run reuses calculator and mask, and restarts from initial positions
+            dimer_init.set_positions(self.init_positions)
+        # MinModeAtoms keeps eigenmode state of previous run, so it is always rebuilt
+        d_atoms = MinModeAtoms(dimer_init, self.d_control)
+        if self.init_eigenmode_method == "displacement":
+            # displace by a copy, so the vector of caller is never handed to ASE
+            d_atoms.displace(displacement_vector=self.displacement_vector.copy())
+        with AsyncTrajectoryWriter(self.traj_file) as dimer_writer:
+            dimer_relax = MinModeTranslate(d_atoms)
+            dimer_relax.attach(lambda: dimer_writer.put([snapshot_atoms(dimer_init, properties)]))
+            dimer_relax.run(fmax=fmax)
+        
+def dp_batch_calculate(calc, images):
+    """Evaluate images with same composition by one batched DP forward pass
+    
+    Results are stored in a SinglePointCalculator of each image, 
+    so later get_potential_energy() and get_forces() will not call DP model again
+
+    calc (DPCalculator): DP calculator whose model is used for the batched evaluation
+    images (list): list of Atoms objects with same chemical symbols
+    """
+    nframes = len(images)
+    symbols = images[0].get_chemical_symbols()
+    assert all(image.get_chemical_symbols() == symbols for image in images), \
+    "Batched DP evaluation needs images with the same chemical symbols"
+    coords = np.array([image.get_positions() for image in images]).reshape(nframes, -1)
+    if sum(images[0].get_pbc()) > 0:
+        cells = np.array([image.get_cell()[:] for image in images]).reshape(nframes, -1)
+    else:
+        cells = None
+    atype = [calc.type_dict[k] for k in symbols]
+    energies, forces, _ = calc.dp.eval(coords=coords, cells=cells, atom_types=atype)
+    for ind, image in enumerate(images):
+        image.calc = SinglePointCalculator(image, 
+                                           energy=energies[ind][0], 
+                                           free_energy=energies[ind][0], 
+                                           forces=forces[ind])
+
+def dp_batch_relax(atoms_list, calc, fmax=0.05, steps=None, optimizer=FIRE):
+    """Relax structures with same composition in lock-step by batched DP forward pass
+    
+    In every step, structures not converged are evaluated together and moved by their own optimizer,
+    converged structures are dropped from the batch
+
+    atoms_list (list): list of Atoms objects with same chemical symbols, like IS and FS
+    calc (DPCalculator): DP calculator used for the batched evaluation
+    fmax (float): threshold (unit: eV/Angstrom) of the force convergence
+    steps (int): maximum number of optimization steps, None for no limit like optimizer.run()
+    optimizer (Optimizer): ASE optimizer class used for every structure, default FIRE
+    Returns: True if all structures are converged
+    """
+    opts = [optimizer(atoms, logfile=None) for atoms in atoms_list]
+    active = list(range(len(atoms_list)))
+    step = 0
+    while True:
+        dp_batch_calculate(calc, [atoms_list[ind] for ind in active])
+        fmax_list = [np.sqrt((atoms_list[ind].get_forces() ** 2).sum(axis=1)).max() 
+                     for ind in active]
+        fmax_msg = "  ".join(f"{ind}: {fmax_ind:.6f}" for ind, fmax_ind in zip(active, fmax_list))
+        print(f"DP-Batch-Relax: {step:4d}  fmax  {fmax_msg}")
+        active = [ind for ind, fmax_ind in zip(active, fmax_list) if fmax_ind >= fmax]
+        if not active or (steps is not None and step >= steps):
+            break
+        for ind in active:
+            opts[ind].step()
+        step += 1
+    return not active
+
+class DPBatchDyNEB(DyNEB):
+    """DyNEB which evaluates all moving images by one batched DP forward pass per step"""
+    
+    def __init__(self, images, calc, **kwargs):
+        """Initialize DyNEB with a shared DP calculator
+
+        images (list): NEB chain, intermediate images need no calculator
+        calc (DPCalculator): DP calculator shared by all intermediate images
+        kwargs: other parameters passed to DyNEB
+        """
+        super().__init__(images, **kwargs)
+        self.dp_calc = calc
+    
+    def get_active_images(self):
+        """get intermediate images whose DP results are missing or outdated
+        
+        Images carrying any other calculator, like IDPP during interpolation, are left to that calculator
+        """
+        active_images = []
+        for image in self.images[1:-1]:
+            if image.calc is None:
+                active_images.append(image)
+            elif isinstance(image.calc, SinglePointCalculator) and image.calc.check_state(image):
+                active_images.append(image)
+        return active_images
+    
+    def get_forces(self):
+        """Evaluate all active images in one batch, then get NEB forces from cached results"""
+        active_images = self.get_active_images()
+        if active_images:
+            dp_batch_calculate(self.dp_calc, active_images)
+        forces = BaseNEB.get_forces(self)
+        if not self.dynamic_relaxation:
+            return forces
+        # convergence scaling of DyNEB for all images at once,
+        # instead of rebuilding all positions for every image
+        forces = forces.reshape(self.nimages - 2, self.natoms, 3)
+        positions = self.get_positions().reshape(forces.shape)
+        fmax_images = np.sqrt((forces ** 2).sum(axis=2)).max(axis=1)
+        rel_pos = np.sqrt(((positions - positions[self.imax - 1]) ** 2).sum(axis=(1, 2)))
+        frozen = fmax_images < self.fmax * (1 + rel_pos * self.scale_fmax)
+        # Special case. Do not freeze saddle point
+        frozen[self.imax - 1] = False
+        forces[frozen] = 0
+        return forces.reshape(-1, 3)
+    
+    def _fmax_all(self, images):
+        """get maximum force acting on each intermediate image"""
+        forces = self.get_forces().reshape(self.nimages - 2, self.natoms, 3)
+        return np.sqrt((forces ** 2).sum(axis=2)).max(axis=1)
+    
+    def set_positions(self, positions):
+        """Only move images which are not converged
+        
+        converged mask is determined once before moving any image,
+        so moved images are evaluated together in next get_forces() 
+        instead of one-by-one as in DyNEB
+        """
+        if not self.dynamic_relaxation:
+            return super().set_positions(positions)
+        converged = self._fmax_all(self.images) < self.fmax
+        n1 = 0
+        for i, image in enumerate(self.images[1:-1]):
+            n2 = n1 + self.natoms
+            if not converged[i]:
+                image.set_positions(positions[n1:n2])
+            n1 = n2
+
+@njit(cache=True, fastmath=True)
+def build_displacement(pos_a, pos_b, norm_target):
+    """Get displacement vector from pos_b to pos_a normalized to norm_target length"""
+    diff = pos_a - pos_b
+    return diff * (norm_target / np.sqrt(np.sum(diff * diff)))
+
+@njit(cache=True, fastmath=True)
+def main4dis_kernel(displacement_vector, thr):
+    """Get mask and normalized per-atom norms of displacement vector in one pass"""
+    norm_vector = np.sqrt(np.sum(displacement_vector * displacement_vector, axis=1))
+    norm_vector = norm_vector / np.sqrt(np.sum(norm_vector * norm_vector))
+    return norm_vector > thr, norm_vector
+
 def main4dis(displacement_vector, thr=0.10):
     """Get Main Parts of Displacement Vector by using threshold"""
-    len_vector = np.linalg.norm(displacement_vector)
-    norm_vector = np.linalg.norm(displacement_vector / len_vector, axis=1)
-    main_indices = [ind for ind,vec in enumerate(norm_vector) if vec > thr]
+    main_mask, norm_vector = main4dis_kernel(np.ascontiguousarray(displacement_vector, dtype=np.float64), thr)
+    main_indices = np.flatnonzero(main_mask).tolist()
     return main_indices, norm_vector
 
-def thermo_analysis(atoms, T, name="vib", indices=None, delta=0.01, nfree=2):
-    """Do Thermo Analysis by using ASE"""
-    vib_dir = f"{name}_mode"
-    mode_dir = f"{vib_dir}/{name}"
-    if not os.path.exists(vib_dir):
-        os.mkdir(f"{name}_mode")   
-    vib = Vibrations(atoms, indices=indices, name=name, delta=delta, nfree=nfree)
-    vib.run()
-    vib.summary()
-    ROOT_DIR = os.getcwd()
-    os.chdir(f"{name}_mode")
-    vib.write_mode()
-    os.chdir(ROOT_DIR)
+class DPBatchVibrations(Vibrations):
+    """Vibrations whose finite displacements are evaluated by batched DP forward pass"""
+    
+    def __init__(self, atoms, calc, **kwargs):
+        """Initialize Vibrations with a DP calculator
+
+        atoms (Atoms object): structure to do vibrational analysis
+        calc (DPCalculator): DP calculator used for the batched evaluation
+        kwargs: other parameters passed to Vibrations, like indices, name, delta and nfree
+        """
+        super().__init__(atoms, **kwargs)
+        self.dp_calc = calc
+    
+    def get_pending_displacements(self):
+        """get displacements and displaced Atoms whose forces are not in cache"""
+        if not self.cache.writable:
+            raise RuntimeError("Cannot run calculation. Cache must be removed or split "
+                               "in order to have only one sort of data structure at a time.")
+        return [(disp, atoms) 
+                for disp, atoms in self.iterdisplace(inplace=False) 
+                if disp.name not in self.cache]
+    
+    def save_displacements(self, pending):
+        """save forces of evaluated displacements into cache read by summary() and get_energies()"""
+        for disp, atoms in pending:
+            with self.cache.lock(disp.name) as handle:
+                if handle is None:
+                    continue
+                handle.save({"forces": atoms.get_forces(apply_constraint=False)})
+    
+    def run(self):
+        """run all finite displacements by one batched DP forward pass"""
+        run_batch_vibrations([self], self.dp_calc)
+
+def run_batch_vibrations(vibs, calc):
+    """Run finite displacements of several Vibrations by one batched DP forward pass
+    
+    vibs (list): list of DPBatchVibrations for structures with same chemical symbols, like TS, IS and FS
+    calc (DPCalculator): DP calculator used for the batched evaluation
+    """
+    pending = [(vib, vib.get_pending_displacements()) for vib in vibs]
+    displaced = [atoms for _, disps in pending for _, atoms in disps]
+    if displaced:
+        dp_batch_calculate(calc, displaced)
+    for vib, disps in pending:
+        vib.save_displacements(disps)
+
+def thermo_analysis(vib, T, log=None):
+    """Do Thermo Analysis by using ASE from finished Vibrations, results are printed to log (default stdout)"""
+    if log is None:
+        log = sys.stdout
+    name = Path(vib.name).name
+    mode_dir = ROOT_DIR / f"{name}_mode"
+    mode_dir.mkdir(exist_ok=True)
+    vib.summary(log=log)
     vib_energies = vib.get_energies()
+    # same mode files as vib.write_mode(), but written into mode_dir without changing cwd
+    vib_data = vib.get_vibrations()
+    for n, energy in enumerate(vib_energies):
+        if abs(energy) > 1e-5:
+            with Trajectory(mode_dir / f"{name}.{n}.traj", "w") as traj:
+                for image in vib_data.iter_animated_mode(n, temperature=units.kB * 300, frames=30):
+                    traj.write(image)
     thermo = HarmonicThermo(vib_energies, ignore_imag_modes=True,)
     entropy = thermo.get_entropy(T)
     free_energy = thermo.get_helmholtz_energy(T)
-    print(f"==> Entropy: {entropy:.6e} eV/K <==")
-    print(f"==> Free Energy: {free_energy:.6f} eV <==")
-    print()
-
-# run neb
-images = [atom_init]
-for i in range(n_max):
-    image = atom_init.copy()
-    image.set_calculator(DP(model=model))
-    images.append(image)
-images.append(atom_final)
-neb = DyNEB(images, 
-            climb=climb, dynamic_relaxation=True, fmax=neb_fmax,
-            method=neb_algorism, parallel=False, scale_fmax=scale_fmax,
-            allow_shared_calculator=True)
-neb.interpolate(method="idpp")
-
-traj = Trajectory(neb_traj, 'w', neb)
-opt = FIRE(neb, trajectory=traj)
-opt.run(neb_fmax)
-
-# neb displacement to dimer
-n_images = NEBTools(images)._guess_nimages()
-neb_raw_barrier = max([image.get_potential_energy() for image in images])
-fmax = NEBTools(images).get_fmax()
-barrier = NEBTools(images).get_barrier()[0]
-TS_info = [(ind, image) 
-            for ind, image in enumerate(images) 
-            if image.get_potential_energy() == neb_raw_barrier][0]
-print(f"=== Locate TS in {TS_info[0]} of 0-{n_images-1} images  ===")
-print(f"=== NEB Raw Barrier: {neb_raw_barrier:.4f} (eV) ===")
-print(f"=== NEB Fmax: {fmax:.4f} (eV/A) ===")
-print(f"=== Now Turn to Dimer with NEB Information ===")
-
-# para for neb2dimer
-step_before_TS = 1
-step_after_TS = 1
-norm_vector = 0.01
-#out_vec = 'displacement_vector.npy',
-
-ind_before_TS = TS_info[0] - step_before_TS
-ind_after_TS = TS_info[0] + step_after_TS
-img_before = images[ind_before_TS]
-img_after = images[ind_after_TS]
-image_vector = (img_before.positions - img_after.positions)
-modulo_norm = np.linalg.norm(image_vector) / norm_vector
-displacement_vector = image_vector / modulo_norm
-print(f"=== Displacement vector generated by {ind_before_TS} and {ind_after_TS} images of NEB chain ===")
-print(f"=== Which is normalized to {norm_vector} length ! ===")
-#np.save(out_vec,displacement_vector)
-
-# dimer part
-dimer_init = TS_info[1].copy()
-init_eigenmode_method = "displacement"
-dimer = DPDimer(dimer_init, model=model,
-                        omp=omp, 
-                        init_eigenmode_method=init_eigenmode_method,
-                        traj_file=dimer_traj,
-                        displacement_vector=displacement_vector)
-dimer.run(fmax=dimer_fmax)
-
-# get struc of IS,FS,TS
-write("IS_get.cif", atom_init, format="cif")
-write("FS_get.cif", atom_final, format="cif")
-write("TS_get.cif", dimer_init, format="cif")
-write("IS_get.stru", atom_init, format="abacus")
-write("FS_get.stru", atom_final, format="abacus")
-write("TS_get.stru", dimer_init, format="abacus")
-
-# get energy informations
-ene_init = atom_init.get_potential_energy()
-ene_final = atom_final.get_potential_energy()
-ene_ts = dimer_init.get_potential_energy()
-ene_delta = ene_final - ene_init
-ene_activa = ene_ts - ene_init
-ene_act_rev = ene_ts - ene_final
-msg = f'''
+    print(f"==> Entropy: {entropy:.6e} eV/K <==", file=log)
+    print(f"==> Free Energy: {free_energy:.6f} eV <==", file=log)
+    print(file=log)
+
+def vib_worker(atoms, T, name, model, omp, cpus=None, **vib_kwargs):
+    """Run vibration and thermo analysis of one structure in a child process
+    
+    Returns the printed results, so that parent process prints them in order
+    """
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(omp)
+    vib = DPBatchVibrations(atoms, get_dp_calculator(model), name=name, **vib_kwargs)
+    vib.run()
+    log = io.StringIO()
+    thermo_analysis(vib, T, log=log)
+    return log.getvalue()
+
+def parallel_thermo_analysis(atoms_list, names, T, model, omp, gpus=None, **vib_kwargs):
+    """Run vibrations and thermo analysis of several structures in parallel processes
+    
+    Every process loads its own DP model on a distinct GPU if gpus is given, 
+    otherwise it is pinned to its own CPU cores, using omp threads when there are enough cores 
+    and an equal share of available cores otherwise
+
+    atoms_list (list): structures to do vibrational analysis, like TS, IS and FS
+    names (list): Vibrations name of each structure
+    T (float): temperature (unit: K) of thermo analysis
+    model (str): DeepPotential model
+    omp (int): number of threads of each process
+    gpus (list): CUDA device of each process like ["0", "1", "2"], None for running on CPU.
+        Must have one device for every structure
+    vib_kwargs: other parameters passed to Vibrations, like indices, delta and nfree
+    Returns: list of printed results of each structure
+    """
+    if gpus and len(gpus) < len(atoms_list):
+        raise ValueError(f"{len(atoms_list)} GPUs are needed for parallel vibrations, but only {len(gpus)} given: {gpus}")
+    # forked children can not re-initialize CUDA, and spawned children 
+    # read CUDA_VISIBLE_DEVICES once they import torch
+    ctx = multiprocessing.get_context("spawn")
+    cuda_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    available_cpus = sorted(os.sched_getaffinity(0))
+    worker_omp = omp
+    if not gpus:
+        # never oversubscribe CPU cores when workers share them
+        worker_omp = max(1, min(omp, len(available_cpus) // len(atoms_list)))
+    executors = []
+    futures = []
+    try:
+        for ind, (atoms, name) in enumerate(zip(atoms_list, names)):
+            cpus = None
+            if gpus:
+                os.environ["CUDA_VISIBLE_DEVICES"] = gpus[ind]
+            elif len(available_cpus) >= len(atoms_list):
+                cpus = set(available_cpus[ind * worker_omp:(ind + 1) * worker_omp])
+            # the child process is started in submit, inheriting current environment
+            executor = ProcessPoolExecutor(max_workers=1, mp_context=ctx)
+            executors.append(executor)
+            futures.append(executor.submit(vib_worker, atoms.copy(), T, name, model, worker_omp, 
+                                           cpus=cpus, **vib_kwargs))
+    finally:
+        if cuda_devices is None:
+            os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+        else:
+            os.environ["CUDA_VISIBLE_DEVICES"] = cuda_devices
+    try:
+        return [future.result() for future in futures]
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+if __name__ == "__main__":
+    # reading part
+    if len(sys.argv) < 2:
+        print(msg)
+        sys.exit(1)
+    elif len(sys.argv) == 2:
+        if sys.argv[1] == "-h" or sys.argv[1] == "--help":
+            print(msg)
+            sys.exit(0)
+        else:
+            neb_traj = sys.argv[1]
+            neb_abacus = read(neb_traj, ":", format="traj")
+            atom_init = neb_abacus[0]
+            atom_final = neb_abacus[-1]
+            assert type(atom_init) == Atoms and type(atom_final) == Atoms, \
+            "The input file is not a trajectory file contained Atoms object"
+    else:
+        init_stru = sys.argv[1]
+        final_stru = sys.argv[2]
+        if len(sys.argv) == 4:
+            format = sys.argv[3]
+        else:
+            format = None # auto detect
+        atom_init = read(init_stru, format=format)
+        atom_final = read(final_stru, format=format)
+
+    # relax IS and FS together
+    dp_calc = get_dp_calculator(model)
+    if compile_model:
+        compile_dp_calculator(dp_calc, atom_init)
+    if not dp_batch_relax([atom_init, atom_final], dp_calc, fmax=0.05):
+        raise RuntimeError("IS and FS relaxation is not converged, check the structures before running NEB")
+
+    write("init_opted.traj", atom_init, format="traj")
+    write("final_opted.traj", atom_final, format="traj")
+
+    # run neb
+    # positions of intermediate images are overwritten by interpolation
+    images = [atom_init] + [atom_init.copy() for _ in range(n_max)] + [atom_final]
+    neb = DPBatchDyNEB(images, dp_calc,
+                climb=climb, dynamic_relaxation=True, fmax=neb_fmax,
+                method=neb_algorism, parallel=False, scale_fmax=scale_fmax,
+                allow_shared_calculator=True)
+    # IDPP calculators are attached to images during interpolation,
+    # DPBatchDyNEB leaves them alone, so no DP evaluation happens here
+    neb.interpolate(method="idpp", mic=True)
+
+    with AsyncTrajectoryWriter(neb_traj) as neb_writer:
+        opt = FIRE(neb)
+        opt.attach(lambda: neb_writer.put([snapshot_atoms(image) for image in images]))
+        with dp_precision(dp_calc, neb_precision, probe=atom_init):
+            opt.run(neb_fmax)
+
+    # freeze NEB results, so following analysis never calls DP model again
+    for image in images:
+        image.calc = SinglePointCalculator(image, 
+                                           energy=image.get_potential_energy(), 
+                                           forces=image.get_forces(apply_constraint=False))
+
+    # neb displacement to dimer
+    neb_tools = NEBTools(images)
+    n_images = neb_tools._guess_nimages()
+    fmax = neb_tools.get_fmax()
+    barrier = neb_tools.get_barrier()[0]
+    energies = np.array([image.get_potential_energy() for image in images])
+    neb_raw_barrier = energies.max()
+    ts_ind = int(energies.argmax())
+    TS_info = (ts_ind, images[ts_ind])
+    print(f"=== Locate TS in {TS_info[0]} of 0-{n_images-1} images  ===")
+    print(f"=== NEB Raw Barrier: {neb_raw_barrier:.4f} (eV) ===")
+    print(f"=== NEB Fmax: {fmax:.4f} (eV/A) ===")
+    print(f"=== Now Turn to Dimer with NEB Information ===")
+
+    # para for neb2dimer
+    step_before_TS = 1
+    step_after_TS = 1
+    norm_vector = 0.01
+    #out_vec = 'displacement_vector.npy',
+
+    ind_before_TS = TS_info[0] - step_before_TS
+    ind_after_TS = TS_info[0] + step_after_TS
+    img_before = images[ind_before_TS]
+    img_after = images[ind_after_TS]
+    image_vector = (img_before.positions - img_after.positions)
+    displacement_vector = build_displacement(img_before.positions, img_after.positions, norm_vector)
+    print(f"=== Displacement vector generated by {ind_before_TS} and {ind_after_TS} images of NEB chain ===")
+    print(f"=== Which is normalized to {norm_vector} length ! ===")
+    #np.save(out_vec,displacement_vector)
+
+    # dimer part
+    # NEB chain is not used anymore, so TS image is moved by dimer directly
+    dimer_init = TS_info[1]
+    init_eigenmode_method = "displacement"
+    dimer = DPDimer(dimer_init, model=model,
+                            omp=omp, 
+                            init_eigenmode_method=init_eigenmode_method,
+                            traj_file=dimer_traj,
+                            displacement_vector=displacement_vector,
+                            calc=dp_calc)
+    dimer.run(fmax=dimer_fmax)
+
+    # get struc of IS,FS,TS
+    write("IS_get.cif", atom_init, format="cif")
+    write("FS_get.cif", atom_final, format="cif")
+    write("TS_get.cif", dimer_init, format="cif")
+    write("IS_get.stru", atom_init, format="abacus")
+    write("FS_get.stru", atom_final, format="abacus")
+    write("TS_get.stru", dimer_init, format="abacus")
+
+    # get energy informations
+    ene_init = atom_init.get_potential_energy()
+    ene_final = atom_final.get_potential_energy()
+    ene_ts = dimer_init.get_potential_energy()
+    ene_delta = ene_final - ene_init
+    ene_activa = ene_ts - ene_init
+    ene_act_rev = ene_ts - ene_final
+    msg = f'''
 ==> TS-Search Results <==
 - Items      Energy
 - IS         {ene_init:.6f}
@@ -287,26 +784,38 @@ msg = f'''
 - Ea_f       {ene_activa:.6f}
 - Ea_r       {ene_act_rev:.6f}
 '''
-print(msg)
-
-# use neb2dimer information to do vibration analysis
-print("==> Do Vibrational Analysis by DP Potential <==")
-vib_indices, norm_vector = main4dis(image_vector, thr=0.10)
-print(f"=== TS main moving atoms: {vib_indices} ===")
-T = 523.15 # K
-delta = 0.01
-nfree = 2
-
-vib_is_name = 'vib_is'
-vib_fs_name = 'vib_fs'
-vib_ts_name = 'vib_ts'
+    print(msg)
 
-print("==> For TS Structure <==")
-thermo_analysis(dimer_init, T, name=vib_ts_name, indices=vib_indices, delta=delta, nfree=nfree)
-print("==> For Initial Structure <==")
-thermo_analysis(atom_init, T, name=vib_is_name, indices=vib_indices, delta=delta, nfree=nfree)
-print("==> For Final Structure <==")
-thermo_analysis(atom_final, T, name=vib_fs_name, indices=vib_indices, delta=delta, nfree=nfree)
+    # use neb2dimer information to do vibration analysis
+    print("==> Do Vibrational Analysis by DP Potential <==")
+    vib_indices, norm_vector = main4dis(image_vector, thr=0.10)
+    print(f"=== TS main moving atoms: {vib_indices} ===")
+    T = 523.15 # K
+    delta = 0.01
+    nfree = 2
 
+    vib_is_name = 'vib_is'
+    vib_fs_name = 'vib_fs'
+    vib_ts_name = 'vib_ts'
 
+    if vib_parallel:
+        vib_logs = parallel_thermo_analysis([dimer_init, atom_init, atom_final], 
+                                            [vib_ts_name, vib_is_name, vib_fs_name], 
+                                            T, model, omp, gpus=vib_gpus, 
+                                            indices=vib_indices, delta=delta, nfree=nfree)
+        for label, vib_log in zip(["TS", "Initial", "Final"], vib_logs):
+            print(f"==> For {label} Structure <==")
+            print(vib_log, end="")
+    else:
+        vib_ts = DPBatchVibrations(dimer_init, dp_calc, indices=vib_indices, name=vib_ts_name, delta=delta, nfree=nfree)
+        vib_is = DPBatchVibrations(atom_init, dp_calc, indices=vib_indices, name=vib_is_name, delta=delta, nfree=nfree)
+        vib_fs = DPBatchVibrations(atom_final, dp_calc, indices=vib_indices, name=vib_fs_name, delta=delta, nfree=nfree)
+        # displacements of TS, IS and FS are evaluated together
+        run_batch_vibrations([vib_ts, vib_is, vib_fs], dp_calc)
 
+        print("==> For TS Structure <==")
+        thermo_analysis(vib_ts, T)
+        print("==> For Initial Structure <==")
+        thermo_analysis(vib_is, T)
+        print("==> For Final Structure <==")
+        thermo_analysis(vib_fs, T)
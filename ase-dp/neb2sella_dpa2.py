@@ -1,6 +1,14 @@
-import numpy as np
 import os, sys
 
+# threads must be set before importing numpy and deepmd_pt, 
+# which read them only at import time
+omp = 16
+os.environ['OMP_NUM_THREADS'] = f'{omp}'
+os.environ['MKL_NUM_THREADS'] = f'{omp}'
+os.environ['OPENBLAS_NUM_THREADS'] = f'{omp}'
+
+import numpy as np
+
 from ase.io import read, write, Trajectory
 from ase import Atoms
 from ase.optimize import BFGS, FIRE, QuasiNewton
@@ -20,13 +28,10 @@ neb_fmax = 0.80  # neb should be rough
 sella_fmax = 0.05 # sella use neb guess
 climb = True
 scale_fmax = 1.0 # use dyneb to reduce message far from TS
-omp = 16
 neb_algorism = "improvedtangent"
 neb_log = "neb_images.traj"
 sella_log = "sella_images.traj"
 
-os.environ['OMP_NUM_THREADS'] = "omp"
-
 # reading part
 msg = '''
 Usage: 
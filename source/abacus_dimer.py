@@ -52,8 +52,8 @@ class AbacusDimer:
     def set_d_mask_by_displacement(self):
         """set mask by displacement"""
         print("=== Set mask by displacement vector where displacement is [0,0,0] ===")
-        d_mask = self.displacement_vector != np.zeros(3)
-        d_mask = d_mask[:,0].tolist()
+        # atom is moving if displacement in any direction is non-zero
+        d_mask = np.any(self.displacement_vector != 0.0, axis=1).tolist()
         return d_mask
     
     def set_d_mask_by_constraint(self):